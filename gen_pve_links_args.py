@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import re, sys, subprocess
+import os, re, sys, shutil, subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, defaultdict
+from bisect import bisect_right
 import yaml
+try:
+    from yaml import CSafeLoader as _Loader  # LibYAML C extension
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+# Resolved once instead of a PATH walk per call; must stay absolute (see qm_show)
+QM_BIN = os.path.abspath(shutil.which("qm") or "/usr/sbin/qm")
 
 ETH_RE = re.compile(r'^(?:eth)?(\d+)$', re.IGNORECASE)
-NET_LINE_RE = re.compile(r'^net(\d+):')
-PCI_ADDR_RE = re.compile(r',addr=0x([0-9a-fA-F]+)(?:\.0x[0-9a-fA-F]+)?')
-NETDEV_PCI_ADDR_RE = re.compile(r"virtio-net-pci[^']*addr=0x([0-9a-fA-F]+)", re.IGNORECASE)
-NETDEV_FULL_RE = re.compile(
-    r"virtio-net-pci[^']*mac=([0-9a-fA-F:]+)[^']*netdev=net(\d+)[^']*addr=0x([0-9a-fA-F]+)",
+NET_LINE_RE = re.compile(rb'^[ \t]*net(\d+):', re.MULTILINE)
+# One pass over raw `qm showcmd` output (bytes, no decode); alternatives are tried in order at each position:
+#   nic   - virtio-net-pci device with mac/netdev/addr (reusable NIC)
+#   vaddr - any other virtio-net-pci device with a PCI addr
+#   addr  - PCI addr of any other device
+QM_SHOWCMD_RE = re.compile(
+    rb"virtio-net-pci[^']*?mac=(?P<mac>[0-9a-fA-F:]+)[^']*?netdev=net(?P<netidx>\d+)[^']*?,addr=0x(?P<naddr>[0-9a-fA-F]+)"
+    rb"|virtio-net-pci[^']*?,addr=0x(?P<vaddr>[0-9a-fA-F]+)"
+    rb"|,addr=0x(?P<addr>[0-9a-fA-F]+)(?:\.0x[0-9a-fA-F]+)?",
     re.IGNORECASE
 )
 
@@ -36,10 +50,10 @@ def parse_mac_prefix(pref: str):
 
 def gen_mac(mac_prefix, vmid: int, iface_index: int) -> str:
     b1, b2, b3 = mac_prefix
-    return f"{b1:02x}:{b2:02x}:{b3:02x}:{(vmid >> 8) & 0xff:02x}:{vmid & 0xff:02x}:{iface_index & 0xff:02x}"
+    return bytes((b1, b2, b3, (vmid >> 8) & 0xff, vmid & 0xff, iface_index & 0xff)).hex(":")
 
 def load_cfg(path: Path):
-    d = yaml.safe_load(path.read_text())
+    d = yaml.load(path.read_bytes(), Loader=_Loader)
     if not isinstance(d, dict):
         raise SystemExit("Top-level YAML must be a mapping.")
     defs = d.get("defaults", {})
@@ -51,13 +65,16 @@ def load_cfg(path: Path):
         if not isinstance(item, (list, tuple)) or len(item) != 4:
             raise SystemExit(f"Each link must be [vmA, ethA|A, vmB, ethB|B], got: {item}")
         parsed.append(((int(item[0]), eth_idx(item[1])), (int(item[2]), eth_idx(item[3]))))
+    udp_port_base = int(defs.get("udp_port_base", 40000))  # only first digit used below
+    if udp_port_base < 0:
+        raise SystemExit(f"udp_port_base must be a non-negative integer (got {udp_port_base})")
     return {
         "model": str(defs.get("model", "virtio-net-pci")),
         "host_mtu": int(defs.get("host_mtu", 9300)),
         "rxq": int(defs.get("rx_queue_size", 1024)),
         "txq": int(defs.get("tx_queue_size", 256)),
         "mac_prefix": parse_mac_prefix(defs.get("mac_prefix", "bc:24:99")),
-        "udp_port_base": int(defs.get("udp_port_base", 40000)),  # only first digit used below
+        "udp_port_base": udp_port_base,
         "udp_map": {int(k): v for k, v in (defs.get("udp_ip_by_vm", {})).items()},
         "udp_default_ip": str(defs.get("udp_default_ip", "127.0.0.1")),
         "loopback_if_same_host": bool(defs.get("loopback_if_same_host", True)),
@@ -66,60 +83,53 @@ def load_cfg(path: Path):
         "links": parsed,
     }
 
+def vm_conf_path(vmid: int) -> Path:
+    return Path(f"/etc/pve/qemu-server/{vmid}.conf")
+
 def highest_existing_net_index(vmid: int) -> int:
-    conf_path = Path(f"/etc/pve/qemu-server/{vmid}.conf")
+    conf_path = vm_conf_path(vmid)
     if not conf_path.exists():
         return -1
     try:
-        hi = -1
-        for line in conf_path.read_text().splitlines():
-            m = NET_LINE_RE.match(line.strip())
-            if m:
-                idx = int(m.group(1))
-                if idx > hi:
-                    hi = idx
-        return hi
+        data = conf_path.read_bytes()
+        return max((int(m.group(1)) for m in NET_LINE_RE.finditer(data)), default=-1)
     except Exception:
         return -1
 
-def pci_info(vmid: int):
+# Single `qm showcmd` per VM -> (existing NICs by MAC, used PCI slots, highest virtio-net-pci slot)
+def qm_show(vmid: int):
+    nics = {}
     used = set()
     highest = -1
+    # No local config (new VM): `qm showcmd` would only fail after PVE startup, skip it
+    if not vm_conf_path(vmid).exists():
+        return nics, used, highest
     try:
-        res = subprocess.run(["qm", "showcmd", str(vmid)], capture_output=True, text=True, check=False)
-        if res.returncode != 0:
-            return used, highest
-        out = res.stdout
-        for m in PCI_ADDR_RE.finditer(out):
-            try:
-                used.add(int(m.group(1), 16))
-            except ValueError:
-                pass
-        for m in NETDEV_PCI_ADDR_RE.finditer(out):
-            try:
-                val = int(m.group(1), 16)
-                if val > highest:
-                    highest = val
-            except ValueError:
-                pass
-    except Exception:
-        pass
-    return used, highest
-
-def collect_existing_nics(vmid: int):
-    mapping = {}
-    try:
-        res = subprocess.run(["qm", "showcmd", str(vmid)], capture_output=True, text=True, check=False)
-        if res.returncode != 0:
-            return mapping
-        for m in NETDEV_FULL_RE.finditer(res.stdout):
-            mac = m.group(1).lower()
-            net_idx = int(m.group(2))
-            pci_addr = int(m.group(3), 16)
-            mapping[mac] = (net_idx, pci_addr)
+        # Keep this call eligible for CPython's posix_spawn() fast path (no fork page-table copy):
+        # absolute QM_BIN, close_fds=False (our fds are non-inheritable anyway, PEP 446),
+        # and no preexec_fn/cwd/pass_fds/start_new_session.
+        p = subprocess.Popen([QM_BIN, "showcmd", str(vmid)], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, close_fds=False)
+        data, _ = p.communicate()
+        if p.returncode != 0:
+            return nics, used, highest
+        for m in QM_SHOWCMD_RE.finditer(data):
+            addr = m.group("addr")
+            if addr is not None:
+                used.add(int(addr, 16))
+                continue
+            naddr = m.group("naddr")
+            if naddr is not None:
+                val = int(naddr, 16)
+                nics[m.group("mac").decode("ascii").lower()] = (int(m.group("netidx")), val)
+            else:
+                val = int(m.group("vaddr"), 16)
+            used.add(val)
+            if val > highest:
+                highest = val
     except Exception:
         pass
-    return mapping
+    return nics, used, highest
 
 def main():
     if len(sys.argv) != 2:
@@ -130,90 +140,96 @@ def main():
     if pci_strategy not in ("lowest_free", "next_highest"):
         raise SystemExit(f"Invalid pci_alloc_strategy '{pci_strategy}' (use lowest_free or next_highest)")
     prefix_digit = str(cfg["udp_port_base"])[0]
+    prefix_int = int(prefix_digit)
+
+    # Loop-invariant -device fragments
+    model = cfg["model"]
+    device_tail = f",rx_queue_size={cfg['rxq']},tx_queue_size={cfg['txq']}"
+    if cfg["host_mtu"] > 0:
+        device_tail += f",host_mtu={cfg['host_mtu']}"
 
-    # Count scheduled NIC additions per VM
-    add_counts = {}
-    for (A, _Ai), (B, _Bi) in cfg["links"]:
-        add_counts[A] = add_counts.get(A, 0) + 1
-        add_counts[B] = add_counts.get(B, 0) + 1
+    # Flatten links once; per-VM NIC counts and port allocation below both use this list
+    endpoints = [iface for link in cfg["links"] for iface in link]
+    add_counts = Counter(vm for vm, _e in endpoints)
 
-    # Gather existing NICs per VM (for reuse)
-    existing_nics_by_vm = {vm: collect_existing_nics(vm) for vm in add_counts}
+    # Gather existing NICs and PCI usage per VM (single `qm showcmd` each, queried in parallel)
+    existing_nics_by_vm = {}
+    pci_used = {}
+    highest_nic_slot = {}
+    with ThreadPoolExecutor(max_workers=min(32, len(add_counts))) as ex:
+        shown = ex.map(qm_show, add_counts)
+        net_hi = ex.map(highest_existing_net_index, add_counts)
+        for vm, (nics, used, hi) in zip(add_counts, shown):
+            existing_nics_by_vm[vm], pci_used[vm], highest_nic_slot[vm] = nics, used, hi
 
-    # Starting net indices (only used for NEW interfaces)
-    current_index = {vm: highest_existing_net_index(vm) + 1 for vm in add_counts}
+        # Starting net indices (only used for NEW interfaces)
+        current_index = {vm: hi + 1 for vm, hi in zip(add_counts, net_hi)}
     start_index = current_index.copy()
 
     auto_pci_enabled = cfg["auto_pci_addr"]
     if not auto_pci_enabled:
-        pci_used = {}
-        highest_nic_slot = {}
-        for vm in add_counts:
-            used_slots_set, hi_slot = pci_info(vm)
-            pci_used[vm] = used_slots_set
-            highest_nic_slot[vm] = hi_slot
-        # Reserve bridge slots
-        for vm in pci_used:
-            pci_used[vm].update({0x1e, 0x1f})
+        # Free usable slots per VM, ascending (0x1e/0x1f reserved for bridges)
+        free_slots = {vm: sorted(set(range(0x02, 0x1e)) - used) for vm, used in pci_used.items()}
         def alloc_pci(vm):
-            # next_highest strategy; fallback to lowest_free if would exceed usable range
+            free = free_slots[vm]
+            if not free:
+                raise SystemExit(f"PCI slots 0x02-0x1d exhausted for VM {vm}; set auto_pci_addr:true or free a slot.")
+            # next_highest: first free slot above highest NIC; fallback to lowest_free if none
+            pos = 0
             if pci_strategy == "next_highest":
-                start = max(highest_nic_slot[vm] + 1, 0x02)
-                if start < 0x1e:  # can place at or above 0x02, below 0x1e
-                    for addr in range(start, 0x1e):
-                        if addr not in pci_used[vm]:
-                            pci_used[vm].add(addr)
-                            highest_nic_slot[vm] = max(highest_nic_slot[vm], addr)
-                            return addr
-            # lowest_free (or fallback)
-            for addr in range(0x02, 0x1e):
-                if addr not in pci_used[vm]:
-                    pci_used[vm].add(addr)
-                    if addr > highest_nic_slot[vm]:
-                        highest_nic_slot[vm] = addr
-                    return addr
-            raise SystemExit(f"PCI slots 0x02-0x1d exhausted for VM {vm}; set auto_pci_addr:true or free a slot.")
+                pos = bisect_right(free, highest_nic_slot[vm])
+                if pos == len(free):
+                    pos = 0
+            addr = free.pop(pos)
+            if addr > highest_nic_slot[vm]:
+                highest_nic_slot[vm] = addr
+            return addr
     else:
         alloc_pci = None  # unused
 
-    per_vm_args = {}
-    used_ports = {}
+    per_vm_args = defaultdict(list)
     reused_ifaces = []  # (vm, eth_idx, net_idx, pci_addr)
 
-    def alloc_port(vmid, eth_index):
-        if vmid > 999 or eth_index > 9:
-            raise SystemExit(f"VMID {vmid} must be <=999 and eth index {eth_index} <=9")
-        port = int(f"{prefix_digit}{vmid}{eth_index}")
+    def port_for(vmid, eth_index):
+        if vmid < 1 or vmid > 999 or eth_index > 9:
+            raise SystemExit(f"VMID {vmid} must be 1..999 and eth index {eth_index} <=9")
+        # <prefix><VMID><eth> as digits; scale keeps VMIDs < 100 unpadded like the string form
+        scale = 1000 if vmid >= 100 else 100 if vmid >= 10 else 10
+        port = (prefix_int * scale + vmid) * 10 + eth_index
         if port > 65535:
             raise SystemExit(f"Port {port} out of range")
-        prev = used_ports.get(port)
-        if prev and prev != (vmid, eth_index):
-            raise SystemExit(f"Port collision {port} between VM{vmid} eth{eth_index} and VM{prev[0]} eth{prev[1]}")
-        used_ports[port] = (vmid, eth_index)
         return port
 
+    # Validate the whole link list before any PCI allocation: duplicate interfaces first,
+    # then port ranges. <prefix><VMID><eth> decodes uniquely, so distinct interfaces never share a port.
+    if len(set(endpoints)) != len(endpoints):
+        seen_vm_iface = set()
+        for vm, e in endpoints:
+            if (vm, e) in seen_vm_iface:
+                raise SystemExit(f"Duplicate interface index eth{e} for VM {vm} in links.")
+            seen_vm_iface.add((vm, e))
+    port_by_iface = {iface: port_for(*iface) for iface in endpoints}
+
+    udp_map = cfg["udp_map"]
+    udp_default_ip = cfg["udp_default_ip"]
+
     # Build args
-    seen_vm_iface = set()
     for (A, Ai), (B, Bi) in cfg["links"]:
-        ipA = cfg["udp_map"].get(A, cfg["udp_default_ip"])
-        ipB = cfg["udp_map"].get(B, cfg["udp_default_ip"])
+        ipA = udp_map.get(A, udp_default_ip)
+        ipB = udp_map.get(B, udp_default_ip)
         if cfg["loopback_if_same_host"] and ipA == ipB and ipA not in ("127.0.0.1", "::1"):
             ipA = ipB = "127.0.0.1"
 
-        macA = gen_mac(cfg["mac_prefix"], A, Ai).lower()
-        macB = gen_mac(cfg["mac_prefix"], B, Bi).lower()
+        macA = gen_mac(cfg["mac_prefix"], A, Ai)
+        macB = gen_mac(cfg["mac_prefix"], B, Bi)
 
-        portA = alloc_port(A, Ai)
-        portB = alloc_port(B, Bi)
+        portA = port_by_iface[(A, Ai)]
+        portB = port_by_iface[(B, Bi)]
 
         for vm, eth_idx, mac, local_ip, local_port, remote_ip, remote_port in [
             (A, Ai, macA, ipA, portA, ipB, portB),
             (B, Bi, macB, ipB, portB, ipA, portA)
         ]:
-            if (vm, eth_idx) in seen_vm_iface:
-                raise SystemExit(f"Duplicate interface index eth{eth_idx} for VM {vm} in links.")
-            seen_vm_iface.add((vm, eth_idx))
-
             # Reuse existing NIC if MAC present
             existing = existing_nics_by_vm.get(vm, {})
             reuse_idx = reuse_pci = None
@@ -230,58 +246,31 @@ def main():
 
             if not auto_pci_enabled:
                 if reuse_pci is not None:
-                    if reuse_pci not in pci_used[vm]:
-                        pci_used[vm].add(reuse_pci)
-                    parts = [
-                        f"-device {cfg['model']}",
-                        f"mac={mac}",
-                        f"netdev=net{idx}",
-                        "bus=pci.0",
-                        f"addr=0x{reuse_pci:x}",
-                        f"id=net{idx}",
-                        f"rx_queue_size={cfg['rxq']}",
-                        f"tx_queue_size={cfg['txq']}",
-                    ]
+                    if reuse_pci in free_slots[vm]:
+                        free_slots[vm].remove(reuse_pci)
+                    addr = reuse_pci
                     reused_ifaces.append((vm, eth_idx, idx, reuse_pci))
                 else:
                     addr = alloc_pci(vm)
-                    parts = [
-                        f"-device {cfg['model']}",
-                        f"mac={mac}",
-                        f"netdev=net{idx}",
-                        "bus=pci.0",
-                        f"addr=0x{addr:x}",
-                        f"id=net{idx}",
-                        f"rx_queue_size={cfg['rxq']}",
-                        f"tx_queue_size={cfg['txq']}",
-                    ]
+                device = f"-device {model},mac={mac},netdev=net{idx},bus=pci.0,addr=0x{addr:x},id=net{idx}{device_tail}"
             else:
-                parts = [
-                    f"-device {cfg['model']}",
-                    f"mac={mac}",
-                    f"netdev=net{idx}",
-                    f"id=net{idx}",
-                    f"rx_queue_size={cfg['rxq']}",
-                    f"tx_queue_size={cfg['txq']}",
-                ]
-
-            if cfg["host_mtu"] > 0:
-                parts.append(f"host_mtu={cfg['host_mtu']}")
-            device = ",".join(parts)
-            per_vm_args.setdefault(vm, []).extend([netdev, device])
+                device = f"-device {model},mac={mac},netdev=net{idx},id=net{idx}{device_tail}"
+            per_vm_args[vm].extend((netdev, device))
 
-    if used_ports:
-        print(f"# UDP ports used: {', '.join(str(p) for p in sorted(used_ports))} (formula: {prefix_digit}+VMID+ethIndex)")
+    out = []
+    if port_by_iface:
+        out.append(f"# UDP ports used: {', '.join(str(p) for p in sorted(port_by_iface.values()))} (formula: {prefix_digit}+VMID+ethIndex)")
     if reused_ifaces:
         reused_str = ", ".join(f"VM{vm}:eth{e}->net{n}@0x{pa:x}" for vm, e, n, pa in reused_ifaces)
-        print(f"# Reused existing NICs (kept PCI addr): {reused_str}")
-    print("# Existing netN count per VM respected (starting indices for NEW):")
+        out.append(f"# Reused existing NICs (kept PCI addr): {reused_str}")
+    out.append("# Existing netN count per VM respected (starting indices for NEW):")
     for vm in sorted(start_index):
-        print(f"#   VM {vm}: starting new at net{start_index[vm]}")
-    print("")
+        out.append(f"#   VM {vm}: starting new at net{start_index[vm]}")
+    out.append("")
     for vm in sorted(per_vm_args):
-        print(f"# VM {vm}")
-        print(f"qm set {vm} --args \"{' '.join(per_vm_args[vm])}\"")
+        out.append(f"# VM {vm}")
+        out.append(f"qm set {vm} --args \"{' '.join(per_vm_args[vm])}\"")
+    sys.stdout.write("\n".join(out) + "\n")
 
 if __name__ == "__main__":
     main()